@@ -1,30 +1,43 @@
 import streamlit as st
 import docker
-import pandas as pd
+import os
 import time
-import plotly.express as px
-import plotly.graph_objects as go
+import atexit
+import threading
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 st.set_page_config(page_title="Docker Monitor Hub", layout="wide", page_icon="🐳")
 
+# Host cgroup v2 hierarchy (mounted read-only when running dockerized)
+CGROUP_ROOT = os.environ.get("CGROUP_ROOT", "/sys/fs/cgroup")
+# dockerd reports host pids, which a dockerized monitor (private PID namespace) can't see
+HOST_PROC_VISIBLE = not os.path.exists("/.dockerenv")
+
 # --- Helper Functions ---
 
+@st.cache_resource
+def _connect_docker():
+    # One client (and connection pool) shared by every rerun and session.
+    # Pool is sized above the default 10 since each API stats stream holds a connection.
+    client = docker.from_env(max_pool_size=32)
+    client.ping()
+    atexit.register(client.close)
+    return client
+
 def get_docker_client():
     try:
-        client = docker.from_env()
-        client.ping()
-        return client
+        return _connect_docker()
     except Exception as e:
         st.error(f"Could not connect to Docker Daemon. Ensure the socket is mounted.\nError: {e}")
         return None
 
-def calculate_cpu_percent(d):
-    # CPU usage calculation based on Docker API stats
+def cpu_counters(cpu_stats):
+    # Reduce a stats payload's cpu_stats (or precpu_stats) to the counters the
+    # CPU% formula needs: (total_usage, system_cpu_usage, online_cpus)
     # Handle different Docker API versions/cgroup structures
-    cpu_usage = d.get("cpu_stats", {}).get("cpu_usage", {})
-    precpu_usage = d.get("precpu_stats", {}).get("cpu_usage", {})
+    cpu_usage = cpu_stats.get("cpu_usage", {})
     
     # Get CPU count safely
     percpu = cpu_usage.get("percpu_usage", [])
@@ -32,57 +45,259 @@ def calculate_cpu_percent(d):
         cpu_count = len(percpu)
     else:
         # Fallback for cgroup v2 or incomplete stats
-        cpu_count = d.get("cpu_stats", {}).get("online_cpus", 1)
+        cpu_count = cpu_stats.get("online_cpus", 1)
 
-    cpu_percent = 0.0
-    
-    # Calculate deltas with safety checks
-    cpu_total = float(cpu_usage.get("total_usage", 0.0))
-    precpu_total = float(precpu_usage.get("total_usage", 0.0))
-    
-    system_cpu = float(d.get("cpu_stats", {}).get("system_cpu_usage", 0.0))
-    presystem_cpu = float(d.get("precpu_stats", {}).get("system_cpu_usage", 0.0))
+    return (
+        float(cpu_usage.get("total_usage", 0.0)),
+        float(cpu_stats.get("system_cpu_usage", 0.0)),
+        cpu_count
+    )
+
+def calculate_cpu_percent(sample, prev):
+    # CPU usage between two counter tuples from cpu_counters(); no previous
+    # reading (first cycle, or an empty precpu_stats) reads as 0%
+    if prev is None or not prev[1]:
+        return 0.0
+
+    cpu_total, system_cpu, cpu_count = sample
+    precpu_total, presystem_cpu, _ = prev
     
     cpu_delta = cpu_total - precpu_total
     system_delta = system_cpu - presystem_cpu
 
+    cpu_percent = 0.0
     if system_delta > 0.0 and cpu_delta > 0.0:
         cpu_percent = (cpu_delta / system_delta) * cpu_count * 100.0
     
     return cpu_percent
 
+_BYTE_LABELS = ('', 'K', 'M', 'G', 'T', 'P')
+
 def format_bytes(size):
-    # 2**10 = 1024
-    power = 2**10
-    n = 0
-    power_labels = {0 : '', 1: 'K', 2: 'M', 3: 'G', 4: 'T'}
-    while size > power:
-        size /= power
-        n += 1
-    return f"{size:.2f} {power_labels[n]}B"
-
-def get_container_stats(container):
+    # Unit index straight from the bit length (every 10 bits = x1024)
+    size = int(size)
+    n = 0 if size < 1024 else min(5, (size.bit_length() - 1) // 10)
+    return f"{size / (1 << (10 * n)):.2f} {_BYTE_LABELS[n]}B"
+
+def fetch_stats_oneshot(client, cid):
+    # one-shot skips dockerd's second sample (~100ms instead of ~1-2s); API >= 1.41
+    return client.api.stats(cid, stream=False, one_shot=True)
+
+def _image_label(image):
+    # List payload has the image reference the container was created from
+    return image[7:19] if image.startswith('sha256:') else image
+
+@st.cache_data(ttl=2)
+def list_containers_snapshot(_client):
+    # Plain-dict snapshot built from a single /containers/json call; the
+    # high-level containers.list() would inspect every container and image.
+    return [
+        {
+            'id': c['Id'],
+            'short_id': c['Id'][:12],
+            'name': c['Names'][0].lstrip('/') if c['Names'] else c['Id'][:12],
+            'project': (c['Labels'] or {}).get('com.docker.compose.project', 'Unknown'),
+            'status': c['State'],
+            'status_text': c['Status'],  # e.g. "Up 2 hours", "Exited (0) 5 minutes ago"
+            'image_tag': _image_label(c['Image'])
+        }
+        for c in _client.api.containers(all=True)
+    ]
+
+def restart_container(client, cid):
+    client.api.restart(cid)
+    list_containers_snapshot.clear()
+
+def find_cgroup_dir(cid, pid=None):
+    # Resolve the container's cgroup v2 directory; None if the files aren't
+    # reachable (cgroup v1, Docker Desktop/linuxkit, hierarchy not mounted).
+    candidates = []
+    if pid:
+        try:
+            with open(f"/proc/{pid}/cgroup") as f:
+                for line in f:
+                    # Unified hierarchy entry: "0::/system.slice/docker-<id>.scope".
+                    # Only trust it if it names this container: the pid may belong
+                    # to another process in our PID namespace, or the path may be
+                    # relative to a private cgroup namespace.
+                    if line.startswith("0::") and cid in line:
+                        candidates.append(CGROUP_ROOT + line[3:].strip())
+        except OSError:
+            pass
+    candidates.append(f"{CGROUP_ROOT}/system.slice/docker-{cid}.scope")  # systemd driver
+    candidates.append(f"{CGROUP_ROOT}/docker/{cid}")  # cgroupfs driver
+
+    for path in candidates:
+        # cpu.stat exists even without the memory controller; need both
+        if all(os.path.isfile(os.path.join(path, name)) for name in ("cpu.stat", "memory.current")):
+            return path
+    return None
+
+def read_cgroup_stats(path):
+    # Raw counters from cgroup v2 files, read straight from the kernel
+    with open(os.path.join(path, "cpu.stat")) as f:
+        usage_usec = next(int(line.split()[1]) for line in f if line.startswith("usage_usec "))
+    with open(os.path.join(path, "memory.current")) as f:
+        mem_usage = int(f.read())
+    with open(os.path.join(path, "memory.max")) as f:
+        raw_max = f.read().strip()
+    # Unlimited containers report "max"; use host RAM like `docker stats` does
+    mem_limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") if raw_max == "max" else int(raw_max)
+
+    return {
+        'usage_usec': usage_usec,
+        'memory_usage': mem_usage,
+        'memory_limit': mem_limit,
+        'sampled_ns': time.monotonic_ns()
+    }
+
+@st.cache_data(max_entries=512)
+def build_sparkline_figure(cpu, memory):
+    # CPU (top) and memory (bottom) sparklines in one figure; keyed on the
+    # history tuples so cards whose data didn't change skip the rebuild.
+    # Returns the plain figure dict: cheap to cache and passed as-is to st.plotly_chart.
+    # Plotly is imported lazily: pages with no running containers never load it.
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.05)
+    fig.add_trace(go.Scatter(
+        y=cpu,
+        mode='lines',
+        fill='tozeroy',
+        line=dict(color='#00CC96', width=2),
+        name='CPU'
+    ), row=1, col=1)
+    fig.add_trace(go.Scatter(
+        y=memory,
+        mode='lines',
+        fill='tozeroy',
+        line=dict(color='#636EFA', width=2),
+        name='Memory'
+    ), row=2, col=1)
+    fig.update_layout(
+        height=160,
+        margin=dict(l=0, r=0, t=0, b=0),
+        showlegend=False
+    )
+    fig.update_xaxes(showgrid=False, zeroline=False, showticklabels=False)
+    fig.update_yaxes(showgrid=False, zeroline=False, showticklabels=False)
+    return fig.to_dict()
+
+class StatsStreamer:
+    """Keeps one streaming stats connection per running container.
+
+    Each stream runs in a daemon thread and stores the latest decoded sample,
+    so the render path only reads from memory instead of waiting on dockerd.
+    """
+
+    def __init__(self, client, max_oneshot=16):
+        self.client = client
+        self.cache = {}  # { container_id: latest stats sample }
+        self._threads = {}  # { container_id: (thread, stop_event) }
+        self._lock = threading.Lock()
+        # Caps concurrent one-shot requests so fallbacks can't flood dockerd
+        self._oneshot_slots = threading.BoundedSemaphore(max_oneshot)
+
+    def sync(self, container_ids):
+        # Start streams for new containers and stop streams for gone ones
+        wanted = set(container_ids)
+        with self._lock:
+            for cid in wanted - self._threads.keys():
+                stop = threading.Event()
+                thread = threading.Thread(target=self._run, args=(cid, stop), daemon=True)
+                self._threads[cid] = (thread, stop)
+                thread.start()
+            for cid in self._threads.keys() - wanted:
+                _, stop = self._threads.pop(cid)
+                stop.set()
+                self.cache.pop(cid, None)
+
+    def _run(self, cid, stop):
+        stream = None
+        try:
+            stream = self.client.api.stats(cid, decode=True, stream=True)
+            for sample in stream:
+                if stop.is_set():
+                    break
+                self.cache[cid] = sample
+        except Exception:
+            pass
+        finally:
+            if stream is not None:
+                stream.close()
+            with self._lock:
+                # Allow the next sync() to reopen a stream that ended on its own
+                if self._threads.get(cid, (None, None))[1] is stop:
+                    del self._threads[cid]
+                    self.cache.pop(cid, None)
+
+    def get(self, cid):
+        return self.cache.get(cid)
+
+    def oneshot(self, cid):
+        with self._oneshot_slots:
+            return fetch_stats_oneshot(self.client, cid)
+
+@st.cache_resource
+def get_stats_streamer(_client):
+    # One set of streams per process, shared by every session and rerun;
+    # per-session streamers would leak their threads and sockets on reload.
+    return StatsStreamer(_client)
+
+@st.cache_resource
+def get_stats_executor():
+    # One pool per process, reused across reruns and sessions so cycles
+    # don't spawn and join fresh threads
+    executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='dockerstats')
+    atexit.register(executor.shutdown, wait=False)
+    return executor
+
+def get_container_stats(container, streamer, prev_samples, cgroup_dir=None):
     try:
-        if container.status != 'running':
+        if container['status'] != 'running':
             return None
         
-        # stream=False waits for a sample to calculate CPU. 
-        # This is slow, so we run it in parallel threads.
-        stats = container.stats(stream=False)
-        
-        cpu = calculate_cpu_percent(stats)
-        mem_usage = stats['memory_stats']['usage']
-        mem_limit = stats['memory_stats']['limit']
+        if cgroup_dir:
+            # Fast path: diff cgroup CPU time against wall-clock time between cycles
+            sample = read_cgroup_stats(cgroup_dir)
+            prev = prev_samples.get(container['id'])
+            prev_samples[container['id']] = sample
+            cpu = 0.0
+            if prev and 'usage_usec' in prev:
+                elapsed_ns = sample['sampled_ns'] - prev['sampled_ns']
+                if elapsed_ns > 0:
+                    # usage_usec restarts from 0 if the container restarted between ticks
+                    cpu = max(0.0, (sample['usage_usec'] - prev['usage_usec']) * 1000 / elapsed_ns * 100.0)
+            mem_usage = sample['memory_usage']
+            mem_limit = sample['memory_limit']
+        else:
+            # Latest sample pushed by the background stream
+            stats = streamer.get(container['id'])
+            if stats:
+                # Streamed samples carry dockerd's previous reading in precpu_stats
+                cpu = calculate_cpu_percent(cpu_counters(stats['cpu_stats']), cpu_counters(stats['precpu_stats']))
+            else:
+                # Stream not delivering (yet): take a one-shot sample and diff it
+                # against the counters kept from the previous cycle.
+                stats = streamer.oneshot(container['id'])
+                counters = cpu_counters(stats['cpu_stats'])
+                cpu = calculate_cpu_percent(counters, prev_samples.get(container['id']))
+                prev_samples[container['id']] = counters
+            
+            mem_usage = stats['memory_stats']['usage']
+            mem_limit = stats['memory_stats']['limit']
         mem_percent = (mem_usage / mem_limit) * 100.0
         
         return {
-            'id': container.short_id,
+            'id': container['short_id'],
             'cpu': cpu,
             'memory_mb': mem_usage / (1024 * 1024),
             'memory_percent': mem_percent,
             'timestamp': datetime.now()
         }
-    except Exception as e:
+    except (OSError, KeyError, StopIteration, ZeroDivisionError, docker.errors.DockerException):
+        # Container stopped or vanished mid-read; skip it this cycle
         return None
 
 # --- Main App ---
@@ -96,7 +311,14 @@ if not client:
 
 # Initialize Session State for History
 if 'history' not in st.session_state:
-    st.session_state.history = {} # { container_id: { 'cpu': [], 'memory': [], 'timestamps': [] } }
+    st.session_state.history = {} # { container_id: { 'cpu': deque, 'memory': deque, 'timestamps': deque } }
+
+if 'prev_samples' not in st.session_state:
+    st.session_state.prev_samples = {} # { container_id: last cgroup sample or one-shot CPU counters }
+if 'cgroup_dirs' not in st.session_state:
+    st.session_state.cgroup_dirs = {} # { container_id: cgroup v2 dir, or None to use the API }
+if 'pending_stats' not in st.session_state:
+    st.session_state.pending_stats = {} # { container_id: future still running from an earlier cycle }
 
 # Sidebar Controls
 refresh_interval = st.sidebar.slider("Refresh Interval (s)", 2, 60, 5)
@@ -107,126 +329,131 @@ if st.sidebar.button("Clear History"):
     st.session_state.history = {}
     st.rerun()
 
-# --- Fetch Data (Parallel) ---
+# --- Live Dashboard ---
+# Only this fragment re-runs on each tick; the header and sidebar are left alone.
 
-containers = client.containers.list(all=True)
-running_containers = [c for c in containers if c.status == 'running']
+@st.fragment(run_every=refresh_interval if auto_refresh else None)
+def render_dashboard():
+    # --- Fetch Data (Streamed) ---
 
-# Update Stats if Auto-Refresh or Manual
-if auto_refresh:
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        results = list(executor.map(get_container_stats, running_containers))
-    
-    # Update History
-    for res in results:
-        if res:
-            cid = res['id']
-            if cid not in st.session_state.history:
-                st.session_state.history[cid] = {'cpu': [], 'memory': [], 'timestamps': []}
-            
-            h = st.session_state.history[cid]
-            h['cpu'].append(res['cpu'])
-            h['memory'].append(res['memory_mb'])
-            h['timestamps'].append(res['timestamp'])
+    containers = list_containers_snapshot(client)
+    running_containers = [c for c in containers if c['status'] == 'running']
+
+    # Resolve cgroup dirs once per container; only the rest need an API stream
+    cgroup_dirs = st.session_state.cgroup_dirs
+    running_ids = {c['id'] for c in running_containers}
+    for cid in cgroup_dirs.keys() - running_ids:
+        del cgroup_dirs[cid]
+        st.session_state.prev_samples.pop(cid, None)
+    for c in running_containers:
+        if c['id'] not in cgroup_dirs:
+            path = find_cgroup_dir(c['id'])
+            if path is None and HOST_PROC_VISIBLE:
+                # Custom cgroup parents: locate it via the container's pid (one inspect per container).
+                # Host pids are only visible when the app runs on the host itself.
+                try:
+                    pid = client.api.inspect_container(c['id'])['State']['Pid']
+                    path = find_cgroup_dir(c['id'], pid)
+                except (docker.errors.DockerException, OSError):
+                    pass
+            cgroup_dirs[c['id']] = path
+
+    streamer = get_stats_streamer(client)
+    streamer.sync(c['id'] for c in running_containers if not cgroup_dirs[c['id']])
+
+    # Update Stats if Auto-Refresh or Manual
+    if auto_refresh:
+        prev_samples = st.session_state.prev_samples
+        pending = st.session_state.pending_stats
+        executor = get_stats_executor()
+        futures = {}
+        for c in running_containers:
+            # Still stuck from an earlier cycle (e.g. hung dockerd): don't queue more work
+            if c['id'] in pending and not pending[c['id']].done():
+                continue
+            futures[c['id']] = executor.submit(get_container_stats, c, streamer, prev_samples, cgroup_dirs[c['id']])
+        # Cycle-wide deadline: a slow one-shot fallback is skipped, not waited on
+        done, _ = wait(futures.values(), timeout=3)
+        results = [f.result() for f in done]
+        st.session_state.pending_stats = {
+            cid: f for cid, f in {**pending, **futures}.items()
+            if cid in running_ids and not f.done()
+        }
+        
+        # Update History
+        for res in results:
+            if res:
+                cid = res['id']
+                if cid not in st.session_state.history:
+                    st.session_state.history[cid] = {
+                        'cpu': deque(maxlen=history_window),
+                        'memory': deque(maxlen=history_window),
+                        'timestamps': deque(maxlen=history_window)
+                    }
+                
+                h = st.session_state.history[cid]
+                # Window slider changed: rebuild with the new bound (keeps the newest points)
+                if h['cpu'].maxlen != history_window:
+                    for key in h:
+                        h[key] = deque(h[key], maxlen=history_window)
+                
+                # Bounded deques evict the oldest point on append
+                h['cpu'].append(res['cpu'])
+                h['memory'].append(res['memory_mb'])
+                h['timestamps'].append(res['timestamp'])
+
+    # --- Dashboard Rendering ---
+
+    # Group Containers by Project (single pass over the snapshot)
+    projects = defaultdict(list)
+    for c in containers:
+        projects[c['project']].append(c)
+
+    # Render Grid
+    for project_name, project_containers in projects.items():
+        if project_name == 'Unknown' and not project_containers:
+            continue
             
-            # Trim History
-            if len(h['cpu']) > history_window:
-                h['cpu'] = h['cpu'][-history_window:]
-                h['memory'] = h['memory'][-history_window:]
-                h['timestamps'] = h['timestamps'][-history_window:]
-
-# --- Dashboard Rendering ---
-
-# Group Containers by Project
-projects = {}
-for c in containers:
-    labels = c.labels
-    project_name = labels.get('com.docker.compose.project', 'Unknown')
-    if project_name not in projects:
-        projects[project_name] = []
-    projects[project_name].append(c)
-
-# Render Grid
-for project_name, project_containers in projects.items():
-    if project_name == 'Unknown' and not project_containers:
-        continue
+        st.subheader(f"📂 Instance: {project_name}")
         
-    st.subheader(f"📂 Instance: {project_name}")
-    
-    # Create columns for grid layout (e.g. 3 cards per row)
-    cols = st.columns(3)
-    
-    for i, c in enumerate(project_containers):
-        col = cols[i % 3]
+        # Create columns for grid layout (e.g. 3 cards per row)
+        cols = st.columns(3)
         
-        with col:
-            with st.container(border=True):
-                # Header
-                status_color = "🟢" if c.status == 'running' else "cx🔴"
-                st.markdown(f"**{status_color} {c.name}**")
-                st.caption(f"ID: {c.short_id} | Image: {c.image.tags[0] if c.image.tags else 'N/A'}")
-                
-                # Stats & Graphs
-                if c.status == 'running':
-                    cid = c.short_id
-                    hist = st.session_state.history.get(cid, {})
+        for i, c in enumerate(project_containers):
+            col = cols[i % 3]
+            
+            with col:
+                with st.container(border=True):
+                    # Header
+                    status_color = "🟢" if c['status'] == 'running' else "cx🔴"
+                    st.markdown(f"**{status_color} {c['name']}**")
+                    st.caption(f"ID: {c['short_id']} | Image: {c['image_tag']}")
                     
-                    if hist and hist['cpu']:
-                        last_cpu = hist['cpu'][-1]
-                        last_mem = hist['memory'][-1]
-                        
-                        # Metrics Row
-                        m1, m2 = st.columns(2)
-                        m1.metric("CPU", f"{last_cpu:.1f}%")
-                        m2.metric("Mem", f"{last_mem:.0f} MB")
-                        
-                        # Sparkline Graph (CPU)
-                        fig = go.Figure()
-                        fig.add_trace(go.Scatter(
-                            y=hist['cpu'],
-                            mode='lines',
-                            fill='tozeroy',
-                            line=dict(color='#00CC96', width=2),
-                            name='CPU'
-                        ))
-                        fig.update_layout(
-                            height=80,
-                            margin=dict(l=0, r=0, t=0, b=0),
-                            xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
-                            yaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
-                            showlegend=False
-                        )
-                        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
-                        
-                        # Sparkline Graph (Memory)
-                        fig_mem = go.Figure()
-                        fig_mem.add_trace(go.Scatter(
-                            y=hist['memory'],
-                            mode='lines',
-                            fill='tozeroy',
-                            line=dict(color='#636EFA', width=2),
-                            name='Memory'
-                        ))
-                        fig_mem.update_layout(
-                            height=80,
-                            margin=dict(l=0, r=0, t=0, b=0),
-                            xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
-                            yaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
-                            showlegend=False
-                        )
-                        st.plotly_chart(fig_mem, use_container_width=True, config={'displayModeBar': False})
+                    # Stats & Graphs
+                    if c['status'] == 'running':
+                        cid = c['short_id']
+                        hist = st.session_state.history.get(cid, {})
                         
+                        if hist and hist['cpu']:
+                            last_cpu = hist['cpu'][-1]
+                            last_mem = hist['memory'][-1]
+                            
+                            # Metrics Row
+                            m1, m2 = st.columns(2)
+                            m1.metric("CPU", f"{last_cpu:.1f}%")
+                            m2.metric("Mem", f"{last_mem:.0f} MB")
+                            
+                            # Sparkline Graphs (CPU + Memory)
+                            fig = build_sparkline_figure(tuple(hist['cpu']), tuple(hist['memory']))
+                            st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False}, key=f"spark_{cid}")
+                            
+                        else:
+                            st.info("Waiting for data...")
                     else:
-                        st.info("Waiting for data...")
-                else:
-                    st.warning(f"Status: {c.status}")
-                    if st.button("Restart", key=f"restart_{c.short_id}"):
-                         c.restart()
-                         st.rerun()
-
-    st.divider()
-
-# Auto-refresh Loop
-if auto_refresh:
-    time.sleep(refresh_interval)
-    st.rerun()
+                        st.warning(f"Status: {c['status_text']}")
+                        # Callback runs before the fragment redraws, so the grid picks up the new state
+                        st.button("Restart", key=f"restart_{c['short_id']}", on_click=restart_container, args=(client, c['id']))
+
+        st.divider()
+
+render_dashboard()